@@ -9,6 +9,7 @@ from abc import ABC, abstractmethod
 from collections import Counter, OrderedDict
 from itertools import pairwise
 from pathlib import Path
+from random import Random
 from typing import Iterable, Literal, NamedTuple
 
 from pandas import DataFrame, concat
@@ -321,6 +322,51 @@ def pad_seq2seq_data(batch: list[tuple[int, int]]) -> tuple[Tensor, Tensor]:
     return x_padded, y_padded
 
 
+class LengthBucketedSequences(IterableDataset):
+    """Reorder sequence data so that each batch holds sequences of similar length.
+
+    Batches are only formed correctly when this is wrapped in a DataLoader with the
+    same batch_size, shuffle=False and num_workers=0 - any shuffling or sharding
+    across workers breaks up the buckets and silently loses the length grouping.
+    """
+
+    def __init__(
+        self,
+        dataset: IterableDataset,
+        batch_size: int,
+        batches_per_pool: int = 100,
+        random_seed: int = 42,
+    ):
+        self._dataset = dataset
+        self._batch_size = batch_size
+        self._pool_size = batch_size * batches_per_pool
+        self._rng = Random(random_seed)
+
+    def __len__(self) -> int:
+        return len(self._dataset)
+
+    def __iter__(self) -> Iterable[tuple[Tensor, Tensor]]:
+        pool: list[tuple[Tensor, Tensor]] = []
+        for example in self._dataset:
+            pool.append(example)
+            if len(pool) == self._pool_size:
+                yield from self._bucket(pool)
+                pool = []
+        yield from self._bucket(pool)
+
+    def _bucket(
+        self, pool: list[tuple[Tensor, Tensor]]
+    ) -> Iterable[tuple[Tensor, Tensor]]:
+        """Sort pool by sequence length, then shuffle the order of full batches."""
+        pool = sorted(pool, key=lambda e: len(e[0]))
+        n_full_batches = len(pool) // self._batch_size
+        batch_starts = [i * self._batch_size for i in range(n_full_batches)]
+        self._rng.shuffle(batch_starts)
+        for i in batch_starts:
+            yield from pool[i : i + self._batch_size]
+        yield from pool[n_full_batches * self._batch_size :]
+
+
 class _Tokenizer(ABC):
     """Abstract base class for text tokenizers."""
 
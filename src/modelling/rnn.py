@@ -10,6 +10,7 @@ from tqdm import tqdm
 from modelling.data import PAD_TOKEN_IDX, _Tokenizer
 from modelling.utils import (
     ModelCheckpoint,
+    _copy_state_dict,
     _early_stop,
     decode,
     format_generated_words,
@@ -104,6 +105,7 @@ def train(
 
     train_losses: Dict[int, float] = {}
     val_losses: Dict[int, float] = {}
+    best_val_loss = float("inf")
 
     for epoch in range(1, n_epochs + 1):
         loss_train = tensor(0.0).to(device)
@@ -122,9 +124,10 @@ def train(
         epoch_train_loss = loss_train.item() / len(train_data)
         epoch_val_loss = loss_val.item() / len(val_data)
 
-        if epoch == 1 or epoch_val_loss < min(val_losses.values()):
+        if epoch == 1 or epoch_val_loss < best_val_loss:
+            best_val_loss = epoch_val_loss
             best_checkpoint = ModelCheckpoint(
-                epoch, epoch_train_loss, epoch_val_loss, model.state_dict().copy()
+                epoch, epoch_train_loss, epoch_val_loss, _copy_state_dict(model)
             )
         train_losses[epoch] = epoch_train_loss
         val_losses[epoch] = epoch_val_loss
@@ -2,43 +2,54 @@
 from __future__ import annotations
 
 import math
+import warnings
+from contextlib import AbstractContextManager
 from functools import partial
-from typing import Callable, Literal
+from typing import Callable, Iterable, Literal, NamedTuple
 
 from torch import (
     Tensor,
+    add,
     arange,
+    autocast,
+    bfloat16,
     cos,
+    cuda,
     device,
+    empty,
     exp,
+    inference_mode,
     log,
     manual_seed,
-    no_grad,
     ones,
     sin,
-    sqrt,
     tensor,
-    tril,
     zeros,
 )
+from torch import bool as torch_bool
+from torch import compile as torch_compile
+from torch import long as torch_long
+from torch.backends.cuda import sdp_kernel
 from torch.nn import (
-    CrossEntropyLoss,
     Dropout,
     Embedding,
+    LayerNorm,
     Linear,
     Module,
-    TransformerDecoderLayer,
 )
+from torch.nn.functional import cross_entropy, relu, scaled_dot_product_attention
 from torch.nn.init import xavier_uniform_
 from torch.nn.utils import clip_grad_norm_
 from torch.optim import Adam, Optimizer
 from torch.optim.lr_scheduler import LambdaLR, LRScheduler
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from modelling.data import PAD_TOKEN_IDX, _Tokenizer
 from modelling.utils import (
     ModelCheckpoint,
+    _copy_state_dict,
     _early_stop,
     decode,
     format_generated_words,
@@ -54,42 +65,161 @@ class NextWordPredictionTransformer(Module):
         self._size_vocab = size_vocab
         self._size_embed = size_embed
         self._n_heads = n_heads
+        self._embed_scale = math.sqrt(size_embed)
         self._position_encoder = PositionalEncoding(size_embed)
         self._embedding = Embedding(size_vocab, size_embed)
-        self._decoder = TransformerDecoderLayer(
-            size_embed, n_heads, dim_feedforward=2 * size_embed, batch_first=True
+        self._decoder = FusedDecoderLayer(
+            size_embed, n_heads, dim_feedforward=2 * size_embed
         )
         self._linear = Linear(size_embed, size_vocab)
+        self._linear.weight = self._embedding.weight  # weight tying
         self._init_weights()
 
     def forward(self, x: Tensor) -> Tensor:
-        x_causal_mask, x_padding_mask = self._make_mask(x)
-        out = self._embedding(x) * sqrt(tensor(self._size_embed))
-        out = self._position_encoder(out)
-        out = self._decoder(
-            out,
-            out,
-            tgt_mask=x_causal_mask,
-            tgt_key_padding_mask=x_padding_mask,
-            memory_mask=x_causal_mask,
-            memory_key_padding_mask=x_padding_mask,
-        )
+        # sequences are right-padded, so causal attention never lets a real token see
+        # padding and the padded positions are ignored by the loss - no mask needed.
+        out = self._embed(x)
+        out = self._decoder(out)
+        out = self._linear(out)
+        return out
+
+    def forward_prefill(self, x: Tensor, max_seq_len: int) -> tuple[Tensor, KVCache]:
+        """Process a prompt, caching attention keys and values for later decoding."""
+        kv_cache = self._decoder.make_kv_cache(x.size(0), max_seq_len)
+        out = self._embed(x)
+        out = self._decoder(out, kv_cache=kv_cache)
+        out = self._linear(out)
+        return out, kv_cache
+
+    def forward_decode_one(self, x: Tensor, pos: int, kv_cache: KVCache) -> Tensor:
+        """Process the token at position pos, attending to all cached tokens."""
+        out = self._embed(x, start_pos=pos)
+        out = self._decoder(out, kv_cache=kv_cache, start_pos=pos)
         out = self._linear(out)
         return out
 
+    def _embed(self, x: Tensor, start_pos: int = 0) -> Tensor:
+        """Embed tokens and encode their positions."""
+        out = self._embedding(x)
+        return self._position_encoder(out, scale=self._embed_scale, start_pos=start_pos)
+
     def _init_weights(self) -> NextWordPredictionTransformer:
         """Parameter initialisaion from Attention is all you Need."""
-        for p in self.parameters():
+        for p in self.parameters():  # yields tied weights only once
             if p.dim() > 1:
                 xavier_uniform_(p)
         return self
 
-    def _make_mask(self, x: Tensor) -> tuple[Tensor, Tensor]:
-        """Make causal and padding masks."""
-        causal_mask = ones(x.size(0) * self._n_heads, x.size(1), x.size(1))
-        causal_mask = tril(causal_mask) == 0
-        padding_mask = x == PAD_TOKEN_IDX
-        return causal_mask.to(x.device), padding_mask.to(x.device)
+
+class KVCache(NamedTuple):
+    """Attention keys and values, shape ``[batch_size, n_heads, max_seq_len, size]``."""
+
+    keys: Tensor
+    values: Tensor
+
+
+class FusedDecoderLayer(Module):
+    """Decoder-only transformer layer using fused scaled dot-product attention."""
+
+    def __init__(
+        self,
+        size_embed: int,
+        n_heads: int,
+        dim_feedforward: int,
+        dropout: float = 0.1,
+        max_seq_len: int = 1000,
+    ):
+        super().__init__()
+        if size_embed % n_heads != 0:
+            raise ValueError(f"size_embed={size_embed} not divisible by {n_heads=}")
+        self._size_embed = size_embed
+        self._n_heads = n_heads
+        self._dropout_p = dropout
+        self._q_proj = Linear(size_embed, size_embed)
+        self._k_proj = Linear(size_embed, size_embed)
+        self._v_proj = Linear(size_embed, size_embed)
+        self._o_proj = Linear(size_embed, size_embed)
+        self._linear1 = Linear(size_embed, dim_feedforward)
+        self._linear2 = Linear(dim_feedforward, size_embed)
+        self._norm1 = LayerNorm(size_embed)
+        self._norm2 = LayerNorm(size_embed)
+        self._dropout = Dropout(dropout)
+        self._dropout1 = Dropout(dropout)
+        self._dropout2 = Dropout(dropout)
+
+        causal_mask = ones(max_seq_len, max_seq_len, dtype=torch_bool).tril()
+        self.register_buffer("_causal_mask", causal_mask, persistent=False)
+
+    def forward(
+        self,
+        x: Tensor,
+        kv_cache: KVCache | None = None,
+        start_pos: int = 0,
+    ) -> Tensor:
+        """
+        Arguments:
+            x: Tensor, shape ``[batch_size, seq_len, embedding_dim]``
+            kv_cache: KVCache to append this sequence's keys and values to
+            start_pos: int, position of the first token in x within the sequence
+        """
+        attn = self._self_attention(x, kv_cache, start_pos)
+        x = self._norm1(x + self._dropout1(attn))
+        x = self._norm2(x + self._dropout2(self._feed_forward(x)))
+        return x
+
+    def make_kv_cache(self, batch_size: int, max_seq_len: int) -> KVCache:
+        """Allocate an empty cache for attention keys and values."""
+        size_head = self._size_embed // self._n_heads
+        cache_size = (batch_size, self._n_heads, max_seq_len, size_head)
+        weight = self._k_proj.weight
+        return KVCache(
+            zeros(cache_size, dtype=weight.dtype, device=weight.device),
+            zeros(cache_size, dtype=weight.dtype, device=weight.device),
+        )
+
+    def _self_attention(
+        self,
+        x: Tensor,
+        kv_cache: KVCache | None,
+        start_pos: int,
+    ) -> Tensor:
+        """Causal multi-head self-attention."""
+        batch_size, seq_len, size_embed = x.size()
+        end_pos = start_pos + seq_len
+        q = self._split_heads(self._q_proj(x))
+        k = self._split_heads(self._k_proj(x))
+        v = self._split_heads(self._v_proj(x))
+        if kv_cache is not None:
+            kv_cache.keys[:, :, start_pos:end_pos] = k
+            kv_cache.values[:, :, start_pos:end_pos] = v
+            k = kv_cache.keys[:, :, :end_pos]
+            v = kv_cache.values[:, :, :end_pos]
+
+        dropout_p = self._dropout_p if self.training else 0.0
+        if start_pos == 0:
+            out = scaled_dot_product_attention(
+                q, k, v, dropout_p=dropout_p, is_causal=True
+            )
+        elif seq_len == 1:
+            # a single new token may attend to every cached token, so needs no mask
+            out = scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        else:
+            attn_mask = self._causal_mask[start_pos:end_pos, :end_pos]
+            out = scaled_dot_product_attention(q, k, v, attn_mask, dropout_p)
+        out = out.transpose(1, 2).reshape(batch_size, seq_len, size_embed)
+        return self._o_proj(out)
+
+    def _feed_forward(self, x: Tensor) -> Tensor:
+        """Position-wise feed-forward network."""
+        return self._linear2(self._dropout(relu(self._linear1(x))))
+
+    def _split_heads(self, x: Tensor) -> Tensor:
+        """Reshape [batch, seq_len, embed] to [batch, heads, seq_len, embed / heads]."""
+        batch_size, seq_len, size_embed = x.size()
+        x = x.view(batch_size, seq_len, self._n_heads, size_embed // self._n_heads)
+        # view keeps the unit stride over head features that fused attention kernels
+        # need, so calling .contiguous() here would only add a copy
+        return x.transpose(1, 2)
 
 
 class PositionalEncoding(Module):
@@ -104,18 +234,64 @@ class PositionalEncoding(Module):
         pos_encoding = zeros(max_seq_len, size_embed)
         pos_encoding[:, 0::2] = sin(position * div_term)
         pos_encoding[:, 1::2] = cos(position * div_term)
-        self.register_buffer("_pos_encoding", pos_encoding)  # don't train these
+        # don't train or checkpoint these - Module.to() will still convert their dtype
+        self.register_buffer("_pos_encoding", pos_encoding, persistent=False)
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, scale: float = 1.0, start_pos: int = 0) -> Tensor:
         """
         Arguments:
             x: Tensor, shape ``[batch_size, seq_len, embedding_dim]``
+            scale: float, factor to multiply x by before adding positional encoding
+            start_pos: int, position of the first token in x within the sequence
         """
         seq_len = x.size(1)
-        x = x + self._pos_encoding[:seq_len]
+        pos_encoding = self._pos_encoding[start_pos : start_pos + seq_len].to(x.dtype)
+        x = add(pos_encoding, x, alpha=scale)
         return self._dropout(x)
 
 
+def fused_attention_only() -> AbstractContextManager:
+    """Disable the math fallback for attention, so unsupported inputs raise errors.
+
+    Use this around a CUDA forward pass, ``model(x)``, with bf16 or fp16 inputs (e.g.
+    in a training or validation step under mixed precision), to check that a fused
+    attention kernel is chosen. On torch 2.0 it raises for fp32 inputs while attention
+    dropout is active (training), and for KV cache decoding of multi-token chunks,
+    which pass an explicit attention mask.
+    """
+    return sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
+
+
+def chunked_cross_entropy(
+    logits: Tensor,
+    targets: Tensor,
+    ignore_index: int = PAD_TOKEN_IDX,
+    chunk_size: int = 4096,
+) -> Tensor:
+    """Mean cross-entropy over all tokens, computed chunk_size tokens at a time."""
+    logits = logits.reshape(-1, logits.size(-1))
+    targets = targets.reshape(-1)
+    loss_fn = partial(cross_entropy, ignore_index=ignore_index, reduction="sum")
+    chunk_losses = []
+    for logits_chunk, targets_chunk in zip(
+        logits.split(chunk_size), targets.split(chunk_size)
+    ):
+        if logits_chunk.requires_grad:
+            # recompute log-softmax during backward instead of storing it for all tokens
+            chunk_loss = checkpoint(
+                loss_fn,
+                logits_chunk,
+                targets_chunk,
+                use_reentrant=False,
+                preserve_rng_state=False,  # cross-entropy is deterministic
+            )
+        else:
+            chunk_loss = loss_fn(logits_chunk, targets_chunk)
+        chunk_losses.append(chunk_loss)
+    n_tokens = (targets != ignore_index).sum().clamp(min=1)
+    return sum(chunk_losses) / n_tokens
+
+
 def warmup_schedule(step: int, warmup_steps: int, max_steps: int):
     """Learning rate schedule function taken from GPT-1 paper."""
     lr_factor = 0.5 * (1 + math.cos(math.pi * step / max_steps))
@@ -124,6 +300,49 @@ def warmup_schedule(step: int, warmup_steps: int, max_steps: int):
     return lr_factor
 
 
+def _device_batches(
+    data: DataLoader, device: device
+) -> Iterable[tuple[Tensor, Tensor]]:
+    """Yield batches on device, copying the next batch while this one is used."""
+    if device.type != "cuda":
+        for x_batch, y_batch in data:
+            x = x_batch.to(device, non_blocking=True)
+            y = y_batch.to(device, non_blocking=True)
+            yield x, y
+        return
+
+    if not data.pin_memory:
+        warnings.warn("use DataLoader(pin_memory=True) for asynchronous copies to GPU")
+
+    copy_stream = cuda.Stream(device)
+    compute_stream = cuda.current_stream(device)
+
+    def copy_to_device(batch: tuple[Tensor, Tensor]) -> tuple[Tensor, Tensor]:
+        x_batch, y_batch = (t if t.is_pinned() else t.pin_memory() for t in batch)
+        with cuda.stream(copy_stream):
+            x = x_batch.to(device, non_blocking=True)
+            y = y_batch.to(device, non_blocking=True)
+        return x, y
+
+    def wait_for_copy(batch_device: tuple[Tensor, Tensor]) -> tuple[Tensor, Tensor]:
+        compute_stream.wait_stream(copy_stream)
+        for t in batch_device:
+            t.record_stream(compute_stream)
+        return batch_device
+
+    batches = iter(data)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        return
+    batch_device = copy_to_device(first_batch)
+    for batch in batches:
+        batch_device = wait_for_copy(batch_device)
+        next_batch_device = copy_to_device(batch)
+        yield batch_device
+        batch_device = next_batch_device
+    yield wait_for_copy(batch_device)
+
+
 def _train_step(
     x_batch: Tensor,
     y_batch: Tensor,
@@ -132,11 +351,13 @@ def _train_step(
     optimizer: Optimizer,
     lr_scheduler: LRScheduler,
     clip_grads: float | None = None,
+    mixed_precision: bool = False,
 ) -> Tensor:
     """One iteration of the training loop (for one batch)."""
     model.train()
-    y_pred = model(x_batch)
-    loss_batch = loss_fn(y_pred.permute(0, 2, 1), y_batch)
+    with autocast("cuda", dtype=bfloat16, enabled=mixed_precision):
+        y_pred = model(x_batch)
+        loss_batch = loss_fn(y_pred, y_batch)
 
     optimizer.zero_grad(set_to_none=True)
     loss_batch.backward()
@@ -148,17 +369,19 @@ def _train_step(
     return loss_batch
 
 
-@no_grad()
+@inference_mode()
 def _val_step(
     x_batch: Tensor,
     y_batch: Tensor,
     model: Module,
     loss_fn: Callable[[Tensor, Tensor], Tensor],
+    mixed_precision: bool = False,
 ) -> Tensor:
     """One iteration of the validation loop (for one batch)."""
     model.eval()
-    y_pred = model(x_batch)
-    loss_batch = loss_fn(y_pred.permute(0, 2, 1), y_batch)
+    with autocast("cuda", dtype=bfloat16, enabled=mixed_precision):
+        y_pred = model(x_batch)
+        loss_batch = loss_fn(y_pred, y_batch)
     return loss_batch
 
 
@@ -172,13 +395,23 @@ def train(
     clip_grads: float | None = None,
     random_seed: int = 42,
     device: device = get_best_device(cuda_priority=1, mps_priority=3, cpu_priority=2),
+    compile_model: bool = False,
+    mixed_precision: bool = True,
+    log_interval: int = 20,
 ) -> tuple[dict[int, float], dict[int, float], ModelCheckpoint]:
     """Training loop for transformer decoder."""
     manual_seed(random_seed)
     model.to(device)
+    # compiled model shares parameters with model, so checkpoints come from model
+    model_ = torch_compile(model, mode="reduce-overhead") if compile_model else model
+    # bf16 autocast needs no loss scaling and the optimiser still updates fp32 weights
+    mixed_precision = (
+        mixed_precision and device.type == "cuda" and cuda.is_bf16_supported()
+    )
 
-    optimizer = Adam(model.parameters(), lr=learning_rate)
-    loss_fn = CrossEntropyLoss(ignore_index=PAD_TOKEN_IDX)
+    fused_adam = device.type == "cuda"  # single multi-tensor kernel for all params
+    optimizer = Adam(model.parameters(), lr=learning_rate, fused=fused_adam)
+    loss_fn = chunked_cross_entropy
 
     n_batches = len(train_data)
     n_warmup_steps = math.floor(warmup_epochs * n_batches)
@@ -188,31 +421,34 @@ def train(
 
     train_losses: dict[int, float] = {}
     val_losses: dict[int, float] = {}
+    best_val_loss = float("inf")
 
     print(f"number of warmup steps: {n_warmup_steps} / {n_steps}")
     for epoch in range(1, n_epochs + 1):
-        loss_train = tensor(0.0).to(device)
-        for i, (x_batch, y_batch) in enumerate((pbar := tqdm(train_data)), start=1):
-            x = x_batch.to(device, non_blocking=True)
-            y = y_batch.to(device, non_blocking=True)
-            loss_train += _train_step(x, y, model, loss_fn, optimizer, lrs, clip_grads)
-            lr = lrs.get_last_lr()[0]
-            pbar.set_description(
-                f"epoch {epoch} training loss = {loss_train/i:.4f} (LR = {lr:.8f})"
+        loss_train = zeros((), device=device)
+        pbar = tqdm(_device_batches(train_data, device), total=n_batches)
+        for i, (x, y) in enumerate(pbar, start=1):
+            loss_batch = _train_step(
+                x, y, model_, loss_fn, optimizer, lrs, clip_grads, mixed_precision
             )
+            loss_train += loss_batch.detach()
+            if i % log_interval == 0 or i == n_batches:  # reading loss syncs device
+                lr = lrs.get_last_lr()[0]
+                pbar.set_description(
+                    f"epoch {epoch} training loss = {loss_train/i:.4f} (LR = {lr:.8f})"
+                )
 
-        loss_val = tensor(0.0).to(device)
-        for x_batch, y_batch in val_data:
-            x = x_batch.to(device, non_blocking=True)
-            y = y_batch.to(device, non_blocking=True)
-            loss_val += _val_step(x, y, model, loss_fn)
+        loss_val = zeros((), device=device)
+        for x, y in _device_batches(val_data, device):
+            loss_val += _val_step(x, y, model_, loss_fn, mixed_precision)
 
         epoch_train_loss = loss_train.item() / len(train_data)
         epoch_val_loss = loss_val.item() / len(val_data)
 
-        if epoch == 1 or epoch_val_loss < min(val_losses.values()):
+        if epoch == 1 or epoch_val_loss < best_val_loss:
+            best_val_loss = epoch_val_loss
             best_checkpoint = ModelCheckpoint(
-                epoch, epoch_train_loss, epoch_val_loss, model.state_dict().copy()
+                epoch, epoch_train_loss, epoch_val_loss, _copy_state_dict(model)
             )
 
         train_losses[epoch] = epoch_train_loss
@@ -248,13 +484,21 @@ def generate(
     model.eval()
 
     prompt_tokens = tokenizer(prompt)
-    token_sequence = prompt_tokens.copy()
-    for _ in range(output_length):
-        x = tensor([token_sequence], device=device)
-        token_logits = model(x)
-        token_pred = decode(token_logits[0, -1], strategy, temperature, k=k)
-        token_sequence += [token_pred.item()]
-
-    new_token_sequence = token_sequence[len(prompt_tokens) :]
-    new_token_sequence = token_sequence[len(prompt_tokens) :]
+    n_prompt_tokens = len(prompt_tokens)
+    max_seq_len = n_prompt_tokens + output_length
+    token_sequence = empty(1, max_seq_len, dtype=torch_long, device=device)
+    token_sequence[0, :n_prompt_tokens] = tensor(prompt_tokens)
+
+    # model.to() must stay outside, or moved parameters become inference tensors
+    with inference_mode():
+        x = token_sequence[:, :n_prompt_tokens]
+        token_logits, kv_cache = model.forward_prefill(x, max_seq_len)
+        for pos in range(n_prompt_tokens, max_seq_len):
+            token_pred = decode(token_logits[0, -1], strategy, temperature, k=k)
+            token_sequence[0, pos] = token_pred
+            if pos + 1 < max_seq_len:
+                x = token_sequence[:, pos : pos + 1]
+                token_logits = model.forward_decode_one(x, pos, kv_cache)
+
+    new_token_sequence = token_sequence[0, n_prompt_tokens:].tolist()
     return format_generated_words(tokenizer.tokens2text(new_token_sequence), prompt)
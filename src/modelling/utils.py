@@ -7,9 +7,8 @@ from typing import Any, Dict, Literal, NamedTuple
 
 from pandas import DataFrame
 from seaborn import lineplot
-from torch import Tensor, argmax, cuda, device, load, save, topk
+from torch import Tensor, argmax, cuda, device, load, multinomial, save, softmax, topk
 from torch.backends import mps
-from torch.distributions import Categorical
 from torch.nn import Module
 
 TORCH_MODEL_STORAGE_PATH = Path(".models")
@@ -23,6 +22,11 @@ class ModelCheckpoint(NamedTuple):
     state_dict: Dict[str, Any]
 
 
+def _copy_state_dict(model: Module) -> Dict[str, Any]:
+    """Copy model parameters to CPU, detached from the live (training) tensors."""
+    return {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+
+
 def count_params(model: Module) -> int:
     """Count the number of model parameters."""
     return sum(len(p) for p in model.parameters())
@@ -112,21 +116,21 @@ def _early_stop(train_loss: Dict[int, float], epoch_window: int = 3) -> bool:
 
 def _sample_decoding(logits: Tensor, temperature: float = 1.0) -> Tensor:
     """Generate next token using sample decoding strategy."""
-    return Categorical(logits=logits.squeeze() / temperature).sample()
+    token_probs = softmax(logits.squeeze() / temperature, dim=-1)
+    return multinomial(token_probs, 1).squeeze(-1)
 
 
 def _top_k_decoding(logits: Tensor, temperature: float = 1.0, k: int = 3) -> Tensor:
     """Generate next token using top-k decoding strategy."""
-    token_probs = Categorical(logits=logits.squeeze() / temperature).probs
-    top_k_tokens = topk(token_probs, k=k)
-    sampled_token = Categorical(probs=top_k_tokens.values).sample()
-    return top_k_tokens.indices[sampled_token]
+    top_k_tokens = topk(logits.squeeze() / temperature, k=k)
+    top_k_probs = softmax(top_k_tokens.values, dim=-1)
+    sampled_token = multinomial(top_k_probs, 1)  # index on device to avoid a sync
+    return top_k_tokens.indices.gather(-1, sampled_token).squeeze(-1)
 
 
 def _greedy_decoding(logits: Tensor, temperature: float = 1.0) -> Tensor:
     """Generate next token using greedy decoding strategy."""
-    token_probs = Categorical(logits=logits.squeeze() / temperature).probs
-    return argmax(token_probs)
+    return argmax(logits.squeeze())
 
 
 def decode(
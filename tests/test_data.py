@@ -1,6 +1,18 @@
 """Tests for data creation and handling components."""
 
+from modelling.data import LengthBucketedSequences
 
 
 def test_get_data():
     pass
+
+
+def test_length_bucketed_sequences_batch_similar_lengths():
+    lengths = [5, 1, 4, 2, 6, 3, 8, 7, 9]
+    dataset = [(list(range(n)), list(range(n))) for n in lengths]
+    bucketed_data = LengthBucketedSequences(dataset, batch_size=2, batches_per_pool=4)
+    bucketed_lengths = [len(x) for x, _ in bucketed_data]
+    batches = [bucketed_lengths[i : i + 2] for i in range(0, len(bucketed_lengths), 2)]
+    assert len(bucketed_data) == len(dataset)
+    assert sorted(batches[:4]) == [[1, 2], [3, 4], [5, 6], [7, 8]]
+    assert batches[4] == [9]
@@ -0,0 +1,86 @@
+"""Tests for transformer language modelling components."""
+
+from pytest import mark
+from torch import (
+    allclose,
+    autograd,
+    bfloat16,
+    cuda,
+    manual_seed,
+    no_grad,
+    randint,
+    randn,
+)
+from torch.nn.functional import cross_entropy
+
+from modelling.data import PAD_TOKEN_IDX
+from modelling.transformer import (
+    NextWordPredictionTransformer,
+    chunked_cross_entropy,
+    fused_attention_only,
+)
+
+
+@no_grad()
+def test_kv_cache_decoding_matches_full_forward_pass():
+    manual_seed(42)
+    model = NextWordPredictionTransformer(size_vocab=50, size_embed=16, n_heads=4)
+    model.eval()
+    x = randint(1, 50, (2, 10))
+    seq_len = x.size(1)
+
+    logits = model(x)
+    prefill_logits, kv_cache = model.forward_prefill(x[:, :-1], seq_len)
+    decode_logits = model.forward_decode_one(x[:, -1:], seq_len - 1, kv_cache)
+
+    assert allclose(prefill_logits, logits[:, :-1], atol=1e-5)
+    assert allclose(decode_logits[:, -1], logits[:, -1], atol=1e-5)
+
+
+@no_grad()
+def test_kv_cache_multi_token_decoding_matches_full_forward_pass():
+    manual_seed(42)
+    model = NextWordPredictionTransformer(size_vocab=50, size_embed=16, n_heads=4)
+    model.eval()
+    x = randint(1, 50, (2, 10))
+    seq_len = x.size(1)
+
+    logits = model(x)
+    _, kv_cache = model.forward_prefill(x[:, :-3], seq_len)
+    decode_logits = model.forward_decode_one(x[:, -3:], seq_len - 3, kv_cache)
+
+    assert allclose(decode_logits, logits[:, -3:], atol=1e-5)
+
+
+def test_chunked_cross_entropy_matches_cross_entropy():
+    manual_seed(42)
+    logits = randn(3, 7, 11, requires_grad=True)
+    targets = randint(1, 11, (3, 7))
+    targets[:, -2:] = PAD_TOKEN_IDX
+
+    loss = chunked_cross_entropy(logits, targets, chunk_size=5)
+    expected_loss = cross_entropy(
+        logits.reshape(-1, 11), targets.reshape(-1), ignore_index=PAD_TOKEN_IDX
+    )
+    (grad,) = autograd.grad(loss, logits)
+    (expected_grad,) = autograd.grad(expected_loss, logits)
+
+    assert allclose(loss, expected_loss)
+    assert allclose(grad, expected_grad)
+
+
+@mark.skipif(
+    not (cuda.is_available() and cuda.is_bf16_supported()),
+    reason="requires a CUDA device with bf16 support",
+)
+@no_grad()
+def test_forward_pass_uses_fused_attention_kernel():
+    manual_seed(42)
+    model = NextWordPredictionTransformer(size_vocab=50, size_embed=64, n_heads=4)
+    model.to("cuda", bfloat16).eval()
+    x = randint(1, 50, (2, 10), device="cuda")
+
+    with fused_attention_only():
+        logits = model(x)
+
+    assert logits.size() == (2, 10, 50)
@@ -0,0 +1,27 @@
+"""Tests for helper functions."""
+
+from torch import equal, manual_seed, no_grad, randn, topk
+from torch.nn import Linear
+
+from modelling.utils import _copy_state_dict, decode
+
+
+def test_copy_state_dict_is_not_changed_by_training_updates():
+    model = Linear(4, 2)
+    state_dict = _copy_state_dict(model)
+    expected_weight = model.weight.detach().clone()
+    with no_grad():
+        for p in model.parameters():
+            p.data.add_(1)
+    assert equal(state_dict["weight"], expected_weight)
+    assert not equal(state_dict["weight"], model.weight.detach())
+
+
+def test_topk_decoding_returns_one_of_k_most_likely_tokens():
+    manual_seed(42)
+    logits = randn(20)
+    top_k_tokens = set(topk(logits, k=3).indices.tolist())
+    for _ in range(50):
+        token = decode(logits, "topk", k=3)
+        assert token.dim() == 0
+        assert token.item() in top_k_tokens